@@ -0,0 +1,282 @@
+"""
+Recorded imaplib replies through the hand‑written IMAP parser, the
+txn‑id history, the scan's UID window and the IDLE wait. No network – only stdlib fakes.
+"""
+import binascii, dataclasses, socket, threading, time
+
+import pytest
+
+import zenorc
+
+ALT = (
+    b'(("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 40 2 NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "UTF-8") NIL NIL "BASE64" 2000 30 NIL NIL NIL)'
+    b' "ALTERNATIVE" ("BOUNDARY" "abc") NIL NIL)'
+)
+SUBJECT = b"Subject: =?UTF-8?B?4oK5NSBjcmVkaXRlZA==?=\r\n\r\n"
+QP_BODY = b"Rs. 5.00 has been =\r\ncredited to your account. Reference No: 845009839012"
+
+# multipart/mixed → (alternative → text/plain 1.1, text/html 1.2), image 2
+# whose filename arrives as a literal inside BODYSTRUCTURE
+NESTED_HEAD = (
+    b'2 (UID 12 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "BASE64" 40 2 NIL NIL NIL)'
+    b'("TEXT" "HTML" NIL NIL NIL "7BIT" 20 1 NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "x") NIL NIL)'
+    b'("IMAGE" "PNG" ("NAME" {5}'
+)
+NESTED_TAIL = b') NIL NIL "BASE64" 500 NIL NIL NIL) "MIXED" ("BOUNDARY" "y") NIL NIL) BODY[HEADER.FIELDS (SUBJECT)] {0}'
+
+RECORDED = [
+    (b"1 (UID 11 BODYSTRUCTURE " + ALT + b" BODY[HEADER.FIELDS (SUBJECT)] {%d}" % len(SUBJECT), SUBJECT),
+    (b" BODY[1] {%d}" % len(QP_BODY), QP_BODY),
+    b")",
+    (NESTED_HEAD, "lögo".encode()),
+    (NESTED_TAIL, b""),
+    (b" BODY[1] {3}", b"xyz"),
+    b")",
+    b"3 (FLAGS (\\Seen))",                    # unsolicited update, no UID
+]
+
+
+class FakeIMAP:
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls   = []
+
+    def uid(self, command, uids, items):
+        self.calls.append((command, uids, items))
+        return "OK", self.replies.pop(0)
+
+
+def test_fetch_batch_splits_messages_and_keys_sections():
+    out = zenorc._fetch_batch(FakeIMAP(RECORDED), [b"11", b"12"])
+
+    assert sorted(out) == [b"11", b"12"]
+    assert out[b"11"][b"1"] == QP_BODY
+    assert out[b"11"][b"HEADER.FIELDS (SUBJECT)"] == SUBJECT
+    assert out[b"12"][b"1"] == b"xyz"
+    image = out[b"12"][b"BODYSTRUCTURE"][1]
+    assert image[2] == [b"NAME", "lögo".encode()]  # literal inside the structure
+    assert image[3] is None                          # NIL
+
+
+def test_fetch_batch_empty_reply():
+    assert zenorc._fetch_batch(FakeIMAP([None]), [b"1"]) == {}
+
+
+def test_find_plain():
+    fetched = zenorc._fetch_batch(FakeIMAP(RECORDED), [b"11", b"12"])
+    assert zenorc._find_plain(fetched[b"11"][b"BODYSTRUCTURE"]) == (b"1", b"quoted-printable")
+    assert zenorc._find_plain(fetched[b"12"][b"BODYSTRUCTURE"]) == (b"1.1", b"base64")
+    assert zenorc._find_plain([b"TEXT", b"PLAIN", None, None, None, b"7BIT", 3, 1]) == (b"1", b"7bit")
+    assert zenorc._find_plain([b"TEXT", b"HTML", None, None, None, b"7BIT", 3, 1]) is None
+    assert zenorc._find_plain(None) is None
+
+
+def test_plain_bodies_fetches_other_sections_once():
+    b64  = binascii.b2a_base64(b"INR 5 credited").strip()
+    mail = FakeIMAP(RECORDED, [(b"1 (UID 12 BODY[1.1] {%d}" % len(b64), b64), b")"])
+    fetched = zenorc._fetch_batch(mail, [b"11", b"12"])
+
+    bodies = zenorc._plain_bodies(mail, fetched)
+
+    assert bodies[b"11"] == b"Rs. 5.00 has been credited to your account. Reference No: 845009839012"
+    assert bodies[b"12"] == b"INR 5 credited"
+    assert mail.calls[-1] == ("FETCH", b"12", "(UID BODY.PEEK[1.1])")
+    assert zenorc._subject(zenorc._top_header(fetched[b"11"])) == "₹5 credited"
+
+
+def test_bloom_false_positive_rate_matches_sizing():
+    capacity, rate = 20_000, 0.01
+    bloom = zenorc._Bloom(capacity, rate)
+    for i in range(capacity):
+        bloom.add(f"in-{i}")
+
+    assert all(f"in-{i}" in bloom for i in range(capacity))  # no false negatives
+    probes = 100_000
+    hits   = sum(f"out-{i}" in bloom for i in range(probes))
+    assert hits / probes < 2 * rate
+
+
+# ─────── scan over a scripted inbox ───────
+def _credit(uid: int) -> bytes:
+    return b"Rs. 5.00 has been credited to your account. Reference No: 8450000000%02d" % uid
+
+
+class FakeInbox:
+    """
+    Just enough UID SEARCH / FETCH / STORE for _scan: single‑part
+    text/plain mails, each keyed by its UID.
+    """
+    def __init__(self, uids):
+        self.bodies = {u: _credit(u) for u in uids}
+        self.unseen = set(uids)
+
+    def uid(self, command, *args):
+        if command == "SEARCH":
+            if args[-1] == "UNSEEN":                    # UID <set> UNSEEN
+                wanted = {int(u) for u in args[2].split(",")}
+            else:                                       # UID n:* X-GM-RAW
+                wanted = {u for u in self.bodies if u >= int(args[3].split(":")[0])}
+            return "OK", [b" ".join(b"%d" % u for u in sorted(wanted & self.unseen))]
+        if command == "FETCH":
+            data = []
+            for n, u in enumerate(sorted(int(x) for x in args[0].split(b",")), 1):
+                body = self.bodies[u]
+                data += [
+                    (b'%d (UID %d BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL "7BIT" %d 1 NIL NIL NIL)'
+                     b" BODY[1] {%d}" % (n, u, len(body), len(body)), body),
+                    b")",
+                ]
+            return "OK", data
+        if command == "STORE":
+            self.unseen -= {int(x) for x in args[0].split(b",")}
+            return "OK", [None]
+        raise AssertionError(command)
+
+    def response(self, code):
+        return code, [b"7"] if code == "UIDVALIDITY" else [None]
+
+
+@pytest.fixture
+def inbox(monkeypatch, tmp_path):
+    """
+    One Bloom‑only txn (UID 10's) whose sheet lookup fails until
+    sheet["up"] is set; UID window and state file are per test.
+    """
+    monkeypatch.setattr(zenorc, "CFG", dataclasses.replace(
+        zenorc.CFG, gsheet_url="https://sheet", state_path=str(tmp_path / "state.json")
+    ))
+    history = zenorc._TxnHistory(1, 1000, 0.01)
+    history.add("845000000010")
+    history.add("elsewhere")                  # pushes 10 out of the exact window
+    sheet = {"up": False}
+
+    def sheet_has(txn_id):
+        if not sheet["up"]:
+            raise ConnectionError("sheets unreachable")
+        return False
+
+    monkeypatch.setattr(zenorc, "seen_txn_ids", history)
+    monkeypatch.setattr(zenorc, "_sheet_has", sheet_has)
+    monkeypatch.setattr(zenorc, "uid_window", {"uidvalidity": 1, "last_uid": 9, "unconfirmed": []})
+    mail = FakeInbox(range(10, 15))
+    monkeypatch.setattr(zenorc, "_imap_conn", lambda: mail)
+    return mail, sheet
+
+
+def test_unconfirmed_mail_is_parked_not_blocking_the_window(inbox, monkeypatch):
+    mail, sheet = inbox
+    monkeypatch.setattr(zenorc, "_SCAN_BATCH", 2)      # 5 mails → 3 passes
+
+    assert zenorc.poll_email() == [f"8450000000{u}" for u in (11, 12, 13, 14)]
+    assert zenorc.uid_window["last_uid"] == 14
+    assert zenorc.uid_window["unconfirmed"] == [10]
+    assert mail.unseen == {10}
+
+    sheet["up"] = True
+    assert zenorc.poll_email() == ["845000000010"]
+    assert zenorc.uid_window["unconfirmed"] == []
+    assert mail.unseen == set()
+
+
+def test_unconfirmed_mail_read_elsewhere_is_dropped(inbox):
+    mail, _ = inbox
+    zenorc.poll_email()
+    mail.unseen.clear()                       # read by hand meanwhile
+
+    assert zenorc.poll_email() == []
+    assert zenorc.uid_window["unconfirmed"] == []
+
+
+def test_fresh_state_looks_back_one_batch(monkeypatch, tmp_path):
+    monkeypatch.setattr(zenorc, "CFG", dataclasses.replace(zenorc.CFG, state_path=str(tmp_path / "state.json")))
+    monkeypatch.setattr(zenorc, "uid_window", {"uidvalidity": 0, "last_uid": 0, "unconfirmed": []})
+    mail = FakeInbox(range(1, 41))
+
+    zenorc._check_uidvalidity(mail)
+
+    assert zenorc.uid_window == {"uidvalidity": 7, "last_uid": 10, "unconfirmed": []}
+    assert (tmp_path / "state.json").exists()
+
+
+# ─────── IDLE over a socketpair ───────
+class _PlainSock:
+    def __init__(self, sock):
+        self._sock = sock
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def pending(self):                        # no TLS layer here
+        return 0
+
+
+class _IdleMail:
+    def __init__(self, sock, untagged=None):
+        self.sock               = _PlainSock(sock)
+        self.file               = zenorc._SockReader(sock)
+        self.tagged_commands    = {}
+        self.untagged_responses = dict(untagged or {})
+        self._raw               = sock
+
+    def _new_tag(self):
+        return b"A1"
+
+    def send(self, data):
+        self._raw.sendall(data)
+
+    def readline(self):
+        return self.file.readline()
+
+
+def _idle_against(script: bytes, timeout: float = 3, untagged=None):
+    """
+    → (new mail, seconds taken, lines the server received, the mail)
+    """
+    client, server = socket.socketpair()
+    received: list[bytes] = []
+
+    def serve():
+        f = server.makefile("rb")
+        if not (line := f.readline()):        # IDLE
+            return
+        received.append(line)
+        server.sendall(script)
+        received.append(f.readline())         # DONE
+        server.sendall(b"A1 OK IDLE terminated\r\n")
+
+    threading.Thread(target=serve, daemon=True).start()
+    mail  = _IdleMail(client, untagged)
+    start = time.monotonic()
+    try:
+        return zenorc._idle(mail, timeout), time.monotonic() - start, received, mail
+    finally:
+        client.close()
+        server.close()
+
+
+def test_idle_sees_exists_buffered_behind_another_line():
+    new_mail, took, _, _ = _idle_against(b"+ idling\r\n* 3 EXPUNGE\r\n* 4 EXISTS\r\n")
+    assert new_mail and took < 1
+
+
+def test_idle_accepts_untagged_data_before_continuation():
+    new_mail, took, _, _ = _idle_against(b"* 4 EXISTS\r\n+ idling\r\n")
+    assert new_mail and took < 1
+
+
+def test_idle_returns_exists_left_by_an_earlier_command():
+    # e.g. "* 5 EXISTS" inside the SEARCH reply of the last scan
+    new_mail, took, received, mail = _idle_against(
+        b"+ idling\r\n", untagged={"EXISTS": [b"4", b"5"], "FLAGS": [b"(\\Seen)"]}
+    )
+    assert new_mail and took < 1
+    assert received == []                     # never even entered IDLE
+    assert "EXISTS" not in mail.untagged_responses
+    assert "FLAGS" in mail.untagged_responses
+
+
+def test_idle_times_out_quietly():
+    new_mail, took, received, _ = _idle_against(b"+ idling\r\n", timeout=0.3)
+    assert not new_mail and took >= 0.3
+    assert received == [b"A1 IDLE\r\n", b"DONE\r\n"]
@@ -0,0 +1,10 @@
+# gunicorn -k gthread -w 1 --threads 4 -b 0.0.0.0:$PORT wsgi:app
+# one worker only – the IMAP / MQTT / Sheets threads and their state
+# live in that worker's module globals; don't combine with --preload,
+# the threads would stay behind in the master
+import zenorc
+from zenorc import app
+
+__all__ = ["app"]  # the WSGI callable gunicorn looks up
+
+zenorc.start()
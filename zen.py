@@ -1,19 +1,11 @@
-from flask import Flask
 import os
-import threading
-import zenorc  # Import your main logic file
 
-app = Flask(__name__)
+import zenorc
+from zenorc import app  # single Flask app – every route lives in zenorc.py
 
-@app.route('/')
-def home():
-    return "Zenorc system is live!"
+if __name__ == "__main__":
+    from waitress import serve
 
-# Start the Zenorc processing thread
-def start_bot():
-    zenorc.start()  # You need to put your Zenorc main loop inside a start() function
-
-if __name__ == "_main_":
-    threading.Thread(target=start_bot, daemon=True).start()
+    zenorc.start()
     port = int(os.getenv("PORT", 10000))
-    app.run(host='0.0.0.0', port=port)  # ✅ Correct version
+    serve(app, host="0.0.0.0", port=port, threads=8)
@@ -1,279 +1,1074 @@
 from __future__ import annotations
 
-import email, imaplib, os, re, threading, time, uuid
-from collections import deque
-from datetime import datetime
-from typing import Optional
+import binascii, email.policy, hashlib, imaplib, json, math, os, quopri, random, re
+import selectors, socket, ssl, threading, time, uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from queue import Empty, Queue
+from typing import TYPE_CHECKING
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import gspread, paho.mqtt.client as mqtt
+import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
-from flask import Flask, jsonify
-from oauth2client.service_account import ServiceAccountCredentials
+from flask import Flask, Response
+
+if TYPE_CHECKING:  # imported lazily in _open_sheet at runtime
+    import gspread
 
 # ╭─ ENV ──────────────────────────────────────────────────────────╮
 load_dotenv()
 
-EMAIL_ID       = os.getenv("EMAIL_ID")
-EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+def _env_list(name: str, default: str) -> tuple[str, ...]:
+    return tuple(s.strip().lower() for s in os.getenv(name, default).split(","))
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "false").lower() in ("1", "true", "yes")
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Every knob, read from the environment once (Config.from_env()).
+    Frozen – a stray assignment raises instead of quietly diverging
+    between threads that already read the old value.
+    """
+    email_id: str | None
+    email_password: str | None
+
+    mqtt_broker: str
+    mqtt_port: int
+    mqtt_username: str | None
+    mqtt_password: str | None
+    mqtt_topic: str
+    mqtt_client_id: str
+    mqtt_persistent_session: bool
+    mqtt_retain: bool
+
+    gsheet_url: str | None
+    gsheet_creds_path: str
+
+    gmail_raw_query: str
+    credit_phrases: tuple[str, ...]
+    log_format: str
+    cooldown_seconds: int
+    idle_renew_seconds: int
+    imap_timeout_seconds: int
+    unconfirmed_retry_seconds: int
+    status_max: int
+    state_path: str
+    recent_txn_max: int
+    txn_history_max: int
+    txn_bloom_fpr: float
+    txn_queue_max: int
+    coalesce_payments: bool
+
+    sheet_flush_seconds: float
+    sheet_flush_rows: int
+    sheet_refresh_seconds: int
+
+    def __post_init__(self):
+        if not 0 < self.txn_bloom_fpr < 1:
+            raise ValueError(f"TXN_BLOOM_FPR must be between 0 and 1, got {self.txn_bloom_fpr}")
+        for name in ("status_max", "recent_txn_max", "txn_history_max", "sheet_flush_rows", "idle_renew_seconds",
+                     "imap_timeout_seconds", "unconfirmed_retry_seconds"):
+            if getattr(self, name) <= 0:
+                raise ValueError(f"{name.upper()} must be positive, got {getattr(self, name)}")
+
+    @classmethod
+    def from_env(cls) -> Config:
+        return cls(
+            email_id       = os.getenv("EMAIL_ID"),
+            email_password = os.getenv("EMAIL_PASSWORD"),
+
+            mqtt_broker   = os.getenv("MQTT_BROKER", "localhost"),
+            mqtt_port     = int(os.getenv("MQTT_PORT", "8883")),
+            mqtt_username = os.getenv("MQTT_USERNAME"),
+            mqtt_password = os.getenv("MQTT_PASSWORD"),
+            mqtt_topic    = os.getenv("MQTT_TOPIC", "Zenorc"),
+            # a fixed MQTT_CLIENT_ID lets the broker keep our session (and its
+            # QoS 1 backlog) across reconnects; must be unique per instance
+            mqtt_client_id          = os.getenv("MQTT_CLIENT_ID") or f"zenorc-{uuid.uuid4().hex[:8]}",
+            mqtt_persistent_session = bool(os.getenv("MQTT_CLIENT_ID")),
+            # retained "paid" is re‑delivered on every (re)subscribe – only for
+            # devices that clear it themselves
+            mqtt_retain   = _env_flag("MQTT_RETAIN"),
 
-MQTT_BROKER   = os.getenv("MQTT_BROKER", "localhost")
-MQTT_PORT     = int(os.getenv("MQTT_PORT", "8883"))
-MQTT_USERNAME = os.getenv("MQTT_USERNAME")
-MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
-MQTT_TOPIC    = os.getenv("MQTT_TOPIC", "Zenorc")
-CLIENT_ID     = f"zenorc-{uuid.uuid4().hex[:8]}"
+            gsheet_url        = os.getenv("GSHEET_URL"),
+            gsheet_creds_path = os.getenv("GSHEET_CREDS_PATH", "/etc/secrets/Zenorc.json"),
 
-GSHEET_URL        = os.getenv("GSHEET_URL")
-GSHEET_CREDS_PATH = os.getenv("GSHEET_CREDS_PATH", "/etc/secrets/Zenorc.json")
+            # positive terms only: Gmail's tokenizer can't be trusted with "Rs.5",
+            # "₹ 5,00", … and "-debited" would also match the HTML part or a
+            # footer – amount and debit wording are checked client‑side
+            gmail_raw_query = os.getenv("GMAIL_RAW_QUERY", "is:unread credited"),
+            credit_phrases = _env_list(
+                "CREDIT_PHRASES", "successfully credited,has been credited,credited to your account"
+            ),
+            log_format         = os.getenv("LOG_FORMAT", "{level} {msg}"),
+            cooldown_seconds   = int(os.getenv("COOLDOWN_SECONDS", "40")),
+            idle_renew_seconds = int(os.getenv("IDLE_RENEW_SECONDS", str(25 * 60))),  # Gmail drops IDLE after ~30 min
+            # bounds every single socket read; IDLE itself waits in a selector
+            imap_timeout_seconds = int(os.getenv("IMAP_TIMEOUT_SECONDS", "120")),
+            # IDLE cut short to re‑try mails whose duplicate check hit a Sheets error
+            unconfirmed_retry_seconds = int(os.getenv("UNCONFIRMED_RETRY_SECONDS", "30")),
+            # txn‑ids whose Queued/Completed/… state `status` keeps; SEEN_MAX
+            # is the name from before the UID window, still honoured
+            status_max         = int(os.getenv("STATUS_MAX") or os.getenv("SEEN_MAX") or "50000"),
+            # UID window survives restarts – point it at a persistent volume
+            # (Render's disk is wiped on every deploy); without it each start
+            # looks back only over the newest _SCAN_BATCH matches
+            state_path         = os.getenv("STATE_PATH", "zenorc-state.json"),
+            # seen_txn_ids: exact for the newest RECENT_TXN_MAX, Bloom filter beyond
+            recent_txn_max     = int(os.getenv("RECENT_TXN_MAX", "500")),
+            txn_history_max    = int(os.getenv("TXN_HISTORY_MAX", "1000000")),
+            txn_bloom_fpr      = float(os.getenv("TXN_BLOOM_FPR", "0.0001")),   # ≈ 2.4 MB at 1 M ids
+            txn_queue_max      = int(os.getenv("TXN_QUEUE_MAX", "1000")),
+            # one JSON {"count", "ids"} publish per cooldown instead of one "paid" per txn
+            coalesce_payments  = _env_flag("COALESCE_PAYMENTS"),
 
-SEARCH_STRINGS = tuple(s.strip().lower() for s in os.getenv("SEARCH_STRINGS", "₹5,Rs 5,INR 5").split(","))
-COOLDOWN_SECONDS = int(os.getenv("COOLDOWN_SECONDS", "40"))
+            sheet_flush_seconds   = float(os.getenv("SHEET_FLUSH_SECONDS", "5")),
+            sheet_flush_rows      = int(os.getenv("SHEET_FLUSH_ROWS", "20")),
+            sheet_refresh_seconds = int(os.getenv("SHEET_REFRESH_SECONDS", "60")),
+        )
+
+CFG = Config.from_env()
+SHEET_TOKEN_TTL = 55 * 60  # OAuth access tokens live 1 h – not configurable
 # ╰────────────────────────────────────────────────────────────────╯
 
 # ╭─ STATE ───────────────────────────────────────────────────────╮
-seen_uids: set[bytes]  = set()
-seen_txn_ids: set[str] = set()
-queue: deque[str]      = deque()
-status: dict[str, str] = {}
-last_processed         = 0.0
-imap_lock              = threading.Lock()
+class _BoundedSet:
+    """
+    Insertion‑ordered set that forgets its oldest entries past `maxlen`,
+    so long‑running processes keep a constant working set.
+    """
+    def __init__(self, maxlen: int):
+        self._maxlen = maxlen
+        self._items: OrderedDict = OrderedDict()
+        self._lock   = threading.Lock()
+
+    def __contains__(self, item) -> bool:
+        return item in self._items
+
+    def add(self, item):
+        with self._lock:
+            self._items[item] = None
+            while len(self._items) > self._maxlen:
+                self._items.popitem(last=False)
+
+class _BoundedDict(OrderedDict):
+    """
+    Same policy for mappings: the oldest keys go once `maxlen` is hit.
+    """
+    def __init__(self, maxlen: int):
+        super().__init__()
+        self._maxlen = maxlen
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        while len(self) > self._maxlen:
+            self.popitem(last=False)
+
+class _Bloom:
+    """
+    Fixed‑size Bloom filter on a bytearray, sized for `capacity` items
+    at `error_rate`; k probes by double hashing one blake2b digest.
+    """
+    def __init__(self, capacity: int, error_rate: float):
+        self._m     = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self._k     = max(1, round(self._m / capacity * math.log(2)))
+        self._bits  = bytearray((self._m + 7) // 8)
+        self._lock  = threading.Lock()
+
+    def _probes(self, item: str):
+        d    = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        a, b = int.from_bytes(d[:8], "little"), int.from_bytes(d[8:], "little") | 1
+        return [(a + i * b) % self._m for i in range(self._k)]
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._probes(item))
+
+    def add(self, item: str):
+        probes = self._probes(item)
+        with self._lock:
+            for p in probes:
+                self._bits[p >> 3] |= 1 << (p & 7)
+
+class _TxnHistory:
+    """
+    Every txn‑id ever logged, in constant memory: an exact _BoundedSet
+    of the newest ones plus a Bloom filter for the rest. A hit in the
+    Bloom filter alone is confirmed against the sheet, so a false
+    positive never swallows a real payment; if the sheet can't be
+    reached the lookup raises and the caller retries later. Without a
+    GSHEET_URL there is nothing to confirm against and the hit stands.
+    """
+    def __init__(self, recent: int, capacity: int, error_rate: float):
+        self._recent = _BoundedSet(recent)
+        self._bloom  = _Bloom(capacity, error_rate)
+
+    def __contains__(self, txn_id: str) -> bool:
+        if txn_id in self._recent:
+            return True
+        if txn_id not in self._bloom:
+            return False
+        if not CFG.gsheet_url:
+            log(f"{txn_id} only in the Bloom filter and no sheet to confirm – treated as a duplicate", "WARN")
+            return True
+        if _sheet_has(txn_id):
+            self._recent.add(txn_id)
+            return True
+        return False
+
+    def add(self, txn_id: str):
+        self._recent.add(txn_id)
+        self._bloom.add(txn_id)
+
+    def update(self, txn_ids):
+        for txn_id in txn_ids:
+            self.add(txn_id)
+
+seen_txn_ids: _TxnHistory           = _TxnHistory(CFG.recent_txn_max, CFG.txn_history_max, CFG.txn_bloom_fpr)
+txn_queue: Queue[str]               = Queue(maxsize=CFG.txn_queue_max)
+status: _BoundedDict                = _BoundedDict(CFG.status_max)
+# inbox UIDs ≤ last_uid are done, bar those still listed as unconfirmed
+uid_window: dict                    = {"uidvalidity": 0, "last_uid": 0, "unconfirmed": []}
+last_processed                      = 0.0
+imap_lock                           = threading.Lock()
+imap_conn: imaplib.IMAP4_SSL | None = None
+sheet_rows: Queue[list[str]]        = Queue()
+_SHEET_CACHE: dict                  = {"ws": None, "expires": 0.0, "mtime": 0.0}
+_last_row                           = 0  # sheet rows already folded into seen_txn_ids
 # ╰────────────────────────────────────────────────────────────────╯
 
 # ╭─ UTILS ───────────────────────────────────────────────────────╮
 def log(msg: str, level: str = "INFO"):
-    print(f"{level} {msg}", flush=True)
+    print(CFG.log_format.format(level=level, msg=msg), flush=True)
 
-def tz_mumbai():
-    try:
-        return ZoneInfo("Asia/Mumbai")
-    except:
-        return ZoneInfo("UTC")
+def backoff(attempt: int, base: float = 2, cap: float = 128) -> float:
+    """
+    Capped exponential delay (2 s → 128 s) with ±50 % jitter, so
+    restarted instances don't retry in lock‑step.
+    """
+    return min(cap, base * 2 ** (attempt - 1)) * (0.5 + random.random())
+
+# resolved once – ZoneInfo() hits tzdata on first lookup. Mumbai has no
+# IANA key of its own ("Asia/Mumbai" never resolved, so rows were UTC).
+try:
+    _TZ = ZoneInfo("Asia/Kolkata")
+except ZoneInfoNotFoundError:              # no system tzdata / tzdata wheel
+    _TZ = timezone.utc                     # needs no tzdata either
 # ╰────────────────────────────────────────────────────────────────╯
 
 # ╭─ SHEETS ──────────────────────────────────────────────────────╮
-def _sheet() -> gspread.Worksheet:
-    if not GSHEET_URL:
+def _open_sheet() -> gspread.Worksheet:
+    if not CFG.gsheet_url:
         raise RuntimeError("GSHEET_URL env var missing")
-    if not os.path.isfile(GSHEET_CREDS_PATH):
-        raise FileNotFoundError(f"Credentials not found: {GSHEET_CREDS_PATH}")
+    if not os.path.isfile(CFG.gsheet_creds_path):
+        raise FileNotFoundError(f"Credentials not found: {CFG.gsheet_creds_path}")
+
+    # gspread + oauth2client drag in google‑auth/requests – import on first use
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
 
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(GSHEET_CREDS_PATH, scope)
+    creds = ServiceAccountCredentials.from_json_keyfile_name(CFG.gsheet_creds_path, scope)
     client = gspread.authorize(creds)
-    return client.open_by_url(GSHEET_URL).sheet1
+    return client.open_by_url(CFG.gsheet_url).sheet1
+
+def _sheet(refresh: bool = False) -> gspread.Worksheet:
+    """
+    Cached worksheet – re‑authorizes only when the token is about to
+    expire, the key file was rotated (mtime changed) or on refresh.
+    """
+    try:
+        mtime = os.path.getmtime(CFG.gsheet_creds_path)
+    except OSError:
+        mtime = 0.0
+    cache = _SHEET_CACHE
+    if refresh or cache["ws"] is None or time.time() >= cache["expires"] or mtime != cache["mtime"]:
+        cache.update(ws=_open_sheet(), expires=time.time() + SHEET_TOKEN_TTL, mtime=mtime)
+    return cache["ws"]
+
+def _auth_expired(e: Exception) -> bool:
+    # gspread.exceptions.APIError carries the HTTP response
+    return getattr(getattr(e, "response", None), "status_code", None) in (401, 403)
+
+def _sheet_call(fn):
+    """
+    Runs fn(sheet), reopening the sheet once if Google rejected the token.
+    """
+    try:
+        return fn(_sheet())
+    except Exception as e:
+        if not _auth_expired(e):
+            raise
+        return fn(_sheet(refresh=True))
+
+def _sync_txns():
+    """
+    Reads only the rows below _last_row – O(new rows), not the whole column.
+    Picks up txns logged by other Zenorc instances sharing the sheet.
+    """
+    global _last_row
+    rows = _sheet_call(lambda ws: ws.get(f"A{_last_row + 1}:A", value_render_option="UNFORMATTED_VALUE"))
+    seen_txn_ids.update(str(r[0]) for r in rows if r)
+    _last_row += len(rows)
+
+def _sheet_has(txn_id: str) -> bool:
+    """
+    Exact lookup in column A – only that column is downloaded, not the
+    whole sheet ws.find() would pull. Errors propagate – neither answer
+    is safe to guess (a lost payment vs. firing the device twice).
+    """
+    col = _sheet_call(lambda ws: ws.col_values(1, value_render_option="UNFORMATTED_VALUE"))
+    return txn_id in map(str, col)
 
 def _bootstrap_txns():
     try:
-        return set(_sheet().col_values(1))
+        _sync_txns()
     except Exception as e:
         log(f"Sheets bootstrap failed: {e}", "WARN")
-        return set()
-
-seen_txn_ids = _bootstrap_txns()
 
 def log_payment(txn_id: str, amount: str = "5"):
+    """
+    Non‑blocking: the row is appended by _sheet_worker in the next batch.
+    """
+    day, hms = datetime.now(_TZ).strftime("%Y-%m-%d %H:%M:%S").split(" ")
+    sheet_rows.put([txn_id, amount, day, hms])
+    seen_txn_ids.add(txn_id)
+
+def _append_rows(rows: list[list[str]]):
     try:
-        sheet = _sheet()
-        now = datetime.now(tz_mumbai())
-        sheet.append_row([txn_id, amount, now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S")])
-        seen_txn_ids.add(txn_id)
-        log(f"Logged {txn_id} to Google Sheets")
+        _sheet_call(lambda ws: ws.append_rows(rows, value_input_option="RAW"))
+        log(f"Logged {', '.join(r[0] for r in rows)} to Google Sheets")
     except Exception as e:
         log(f"Sheets Error: {e}", "ERROR")
+
+def _collect_rows(first: list[str]) -> list[list[str]]:
+    """
+    Gathers rows for up to SHEET_FLUSH_SECONDS (or SHEET_FLUSH_ROWS rows).
+    """
+    rows     = [first]
+    deadline = time.monotonic() + CFG.sheet_flush_seconds
+    while len(rows) < CFG.sheet_flush_rows:
+        remain = deadline - time.monotonic()
+        if remain <= 0:
+            break
+        try:
+            rows.append(sheet_rows.get(timeout=remain))
+        except Empty:
+            break
+    return rows
+
+def _sheet_worker():
+    """
+    One thread for all Sheets I/O: batches queued rows into a single
+    append_rows call and re‑syncs seen_txn_ids every
+    SHEET_REFRESH_SECONDS while waiting for the next row.
+    """
+    next_sync = time.monotonic() + CFG.sheet_refresh_seconds
+    while True:
+        try:
+            first = sheet_rows.get(timeout=max(0.0, next_sync - time.monotonic()))
+            _append_rows(_collect_rows(first))
+        except Empty:
+            pass
+
+        if time.monotonic() >= next_sync:
+            try:
+                _sync_txns()
+            except Exception as e:
+                log(f"Sheets refresh failed: {e}", "WARN")
+            next_sync = time.monotonic() + CFG.sheet_refresh_seconds
 # ╰────────────────────────────────────────────────────────────────╯
 
 # ╭─ MQTT ────────────────────────────────────────────────────────╮
-def send_mqtt(max_retries: int = 3, retry_delay: int = 5):
-    for attempt in range(1, max_retries + 1):
-        try:
-            connected = threading.Event()
-            client = mqtt.Client(
-                client_id=CLIENT_ID,
-                protocol=mqtt.MQTTv311,
-                callback_api_version=mqtt.CallbackAPIVersion.VERSION2
-            )
-            if MQTT_USERNAME:
-                client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-
-            def on_connect(c, *_):
-                log("↳ MQTT connected rc=0")
-                connected.set()
-
-            client.on_connect = on_connect
-            client.tls_set()
-            client.connect(MQTT_BROKER, MQTT_PORT)
-            client.loop_start()
-
-            if not connected.wait(timeout=5):
-                raise TimeoutError("MQTT connection timeout")
-
-            rc, mid = client.publish(MQTT_TOPIC, "paid", qos=1)
-            log(f"↳ MQTT publish result = {mqtt.error_string(rc)} (mid={mid})", "INFO" if rc == 0 else "ERROR")
-
-            client.loop_stop()
-            client.disconnect()
-            return rc == mqtt.MQTT_ERR_SUCCESS
-        except Exception as e:
-            log(f"MQTT attempt {attempt} failed: {e}", "WARN")
-            if attempt < max_retries:
-                time.sleep(retry_delay)
-    return False
+_mqtt_connected = threading.Event()
+_MQTT_CLIENT: mqtt.Client | None = None  # created by start()
+
+def _on_connect(client, userdata, flags, reason_code, properties):
+    if reason_code.is_failure:
+        log(f"↳ MQTT connect refused rc={reason_code}", "ERROR")
+        return
+    log(f"↳ MQTT connected rc={reason_code}")
+    _mqtt_connected.set()
+
+def _on_disconnect(client, userdata, flags, reason_code, properties):
+    _mqtt_connected.clear()
+    log(f"↳ MQTT disconnected rc={reason_code} – reconnecting", "WARN")
+
+def _mqtt_client() -> mqtt.Client:
+    """
+    One long‑lived client; paho's network thread reconnects with
+    exponential backoff (2 s → 128 s) whenever the broker drops us.
+    """
+    client = mqtt.Client(
+        client_id=CFG.mqtt_client_id,
+        protocol=mqtt.MQTTv311,
+        clean_session=not CFG.mqtt_persistent_session,  # a random id could never resume
+        callback_api_version=mqtt.CallbackAPIVersion.VERSION2
+    )
+    if CFG.mqtt_username:
+        client.username_pw_set(CFG.mqtt_username, CFG.mqtt_password)
+
+    client.on_connect    = _on_connect
+    client.on_disconnect = _on_disconnect
+    client.enable_logger()  # paho's own warnings (e.g. inflight overflow) via logging
+    client.tls_set()
+    client.reconnect_delay_set(min_delay=2, max_delay=128)
+    client.connect_async(CFG.mqtt_broker, CFG.mqtt_port, 60)
+    client.loop_start()
+    return client
+
+def send_mqtt(payload: str = "paid", timeout: float = 10) -> bool:
+    """
+    Single PUBLISH on the shared connection. Never re‑publishes: a
+    QoS 1 message paho already queued is re‑sent by paho itself.
+    """
+    if not _mqtt_connected.wait(timeout):
+        log("MQTT not connected – publish skipped", "ERROR")
+        return False
+
+    msg_info = _MQTT_CLIENT.publish(CFG.mqtt_topic, payload, qos=1, retain=CFG.mqtt_retain)
+    try:
+        msg_info.wait_for_publish(timeout=timeout)
+    except (RuntimeError, ValueError) as e:
+        log(f"MQTT publish failed: {e}", "ERROR")
+        return False
+
+    ok = msg_info.rc == mqtt.MQTT_ERR_SUCCESS and msg_info.is_published()
+    log(f"↳ MQTT publish result = {mqtt.error_string(msg_info.rc)} (mid={msg_info.mid})", "INFO" if ok else "ERROR")
+    return ok
 # ╰────────────────────────────────────────────────────────────────╯
 
 # ╭─ EMAIL HANDLER ───────────────────────────────────────────────╮
 # ────────── IMAP helper ──────────
+_SSL_CTX = ssl.create_default_context()
+
+class _SockReader:
+    """
+    Stand‑in for the BufferedReader imaplib reads from, with a visible
+    buffer: _idle must know whether a pushed line already sits in
+    user space, which neither select() nor sock.pending() can see.
+    """
+    def __init__(self, sock: ssl.SSLSocket):
+        self._sock = sock
+        self._buf  = bytearray()
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buf)
+
+    def _fill(self) -> bool:
+        chunk = self._sock.recv(65536)
+        self._buf += chunk
+        return bool(chunk)
+
+    def readline(self, limit: int = -1) -> bytes:
+        start = 0
+        while (i := self._buf.find(b"\n", start)) < 0:
+            if 0 <= limit <= len(self._buf):
+                break
+            start = len(self._buf)
+            if not self._fill():
+                break
+        end = i + 1 if i >= 0 else len(self._buf)
+        if limit >= 0:
+            end = min(end, limit)
+        line = bytes(self._buf[:end])
+        del self._buf[:end]
+        return line
+
+    def read(self, size: int) -> bytes:
+        while len(self._buf) < size and self._fill():
+            pass
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def close(self):
+        self._buf.clear()
+
+class _IMAP4_SSL(imaplib.IMAP4_SSL):
+    """
+    Resumes the last TLS session on reconnect (session ticket – skips the
+    full handshake) and disables Nagle so the tiny IDLE/DONE frames
+    aren't held back; SO_KEEPALIVE catches half‑dead connections.
+    """
+    tls_session: ssl.SSLSession | None = None
+
+    def open(self, host="", port=imaplib.IMAP4_SSL_PORT, timeout=None):
+        super().open(host, port, timeout)
+        self.file.close()
+        self.file = _SockReader(self.sock)
+
+    def _create_socket(self, timeout):
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return self.ssl_context.wrap_socket(
+            sock, server_hostname=self.host, session=_IMAP4_SSL.tls_session
+        )
+
 def _imap_login() -> imaplib.IMAP4_SSL:
-    if not EMAIL_ID or not EMAIL_PASSWORD:
+    if not CFG.email_id or not CFG.email_password:
         raise RuntimeError("EMAIL_ID or EMAIL_PASSWORD missing")
-    imap = imaplib.IMAP4_SSL("imap.gmail.com")
-    imap.login(EMAIL_ID, EMAIL_PASSWORD)
+    # a half‑open connection raises TimeoutError instead of hanging for hours
+    imap = _IMAP4_SSL("imap.gmail.com", ssl_context=_SSL_CTX, timeout=CFG.imap_timeout_seconds)
+    imap.login(CFG.email_id, CFG.email_password)
+    _IMAP4_SSL.tls_session = imap.sock.session  # TLS 1.3 tickets arrive after the handshake
     return imap
 
+def _imap_conn() -> imaplib.IMAP4_SSL:
+    """
+    Long‑lived, inbox‑SELECTed connection. Caller holds imap_lock.
+    """
+    global imap_conn
+    if imap_conn is None:
+        imap_conn = _imap_login()
+        imap_conn.select("inbox")
+        _check_uidvalidity(imap_conn)
+    return imap_conn
+
+def _imap_drop():
+    global imap_conn
+    if imap_conn is not None:
+        try:
+            imap_conn.logout()
+        except Exception:
+            pass
+    imap_conn = None
+
+def _idle(mail: imaplib.IMAP4_SSL, timeout: float) -> bool:
+    """
+    RFC 2177 IDLE – imaplib has no native support.
+    True once an untagged EXISTS/RECENT arrives, False on timeout.
+    """
+    # Gmail tucks EXISTS into the reply to any command (SEARCH, FETCH,
+    # STORE…) and imaplib files it under untagged_responses – mail that
+    # arrived during the last scan must not wait out a whole IDLE. Popping
+    # also keeps those lists from growing on the long‑lived connection.
+    pushed = [mail.untagged_responses.pop(k, None) for k in ("EXISTS", "RECENT")]
+    if any(pushed):
+        return True
+
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    new_mail = False
+    while not (line := mail.readline()).startswith(b"+"):
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed before IDLE")
+        if not line.startswith(b"*"):         # untagged data may precede the "+"
+            raise imaplib.IMAP4.error(f"IDLE rejected by server: {line.strip()!r}")
+        new_mail = new_mail or line.rstrip().endswith((b"EXISTS", b"RECENT"))
+
+    deadline = time.monotonic() + timeout
+    try:
+        # epoll/kqueue – select.select() breaks once the fd passes FD_SETSIZE
+        with selectors.DefaultSelector() as sel:
+            sel.register(mail.sock, selectors.EVENT_READ)
+            while not new_mail:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    break
+                # lines can be buffered in user space (mail.file) or in the
+                # TLS layer (pending) – only wait on the socket if neither has any
+                if not mail.file.buffered and not mail.sock.pending() and not sel.select(remain):
+                    break
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed during IDLE")
+                new_mail = line.rstrip().endswith((b"EXISTS", b"RECENT"))
+    finally:
+        mail.send(b"DONE\r\n")
+        while not (line := mail.readline()).startswith(tag):
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed after IDLE")
+            new_mail = new_mail or line.rstrip().endswith((b"EXISTS", b"RECENT"))
+        mail.tagged_commands.pop(tag, None)
+    return new_mail
+
 
 # ─────── reference‑number scraper ───────
-def _extract_txn_id(body: str) -> str:
+_TXN_PATTERNS = (
+    re.compile(rb"Reference\s*(?:No\.?|number)?\s*[:\-]?\s*(\d{8,})", re.I),
+    re.compile(rb"transaction reference number\s*(?:is)?\s*[:\-]?\s*(\d{8,})", re.I),
+)
+
+def _extract_txn_id(body: bytes, uid: bytes) -> str:
     """
     Works with:
       • Reference No.: 845009839012
       • ...reference number is 845009839012
+    Without a reference the UID keeps the fallback unique within a pass.
     """
-    for pat in (
-        r"Reference\s*(?:No\.?|number)?\s*[:\-]?\s*(\d{8,})",
-        r"transaction reference number\s*(?:is)?\s*[:\-]?\s*(\d{8,})",
-    ):
-        m = re.search(pat, body, re.I)
+    for pat in _TXN_PATTERNS:
+        m = pat.search(body)
         if m:
-            return m.group(1)
-    return f"TXN{int(time.time())}"      # fallback – should be rare
+            return m.group(1).decode()
+    return f"TXN{int(time.time())}-{uid.decode()}"      # fallback – should be rare
 
 
 # ─────── credit / amount filters ───────
+# Bytes patterns: the body is matched exactly as fetched, never decoded
+# into a str (₹ is matched as its UTF‑8 sequence) and never lower()ed –
+# re.I does the case folding without copying the body.
 _AMT_5_RE = re.compile(
-    r"(?:₹|rs\.?|inr)\s*[, ]*\s*5(?:[.,]00)?\b",
+    r"(?:₹|rs\.?|inr)\s*[, ]*\s*5(?:[.,]00)?\b".encode(),
     re.I,
 )
+_CREDIT_PHRASE_RE = re.compile(b"|".join(re.escape(p.encode()) for p in CFG.credit_phrases), re.I)
+# \A‑anchored, so each lookahead is a single pass rather than one per offset
+_CREDIT_GATE_RE   = re.compile(rb"\A(?=.*?credited)(?!.*?debited)", re.I | re.S)
 
-def _looks_like_credit(body_lc: str) -> bool:
+def _looks_like_credit(body: bytes) -> bool:
     """
     Only true for INCOMING ₹5 credits.
     """
-    if (
-        "credited" not in body_lc
-        or "debited" in body_lc
-    ):
-        return False
+    return bool(
+        _CREDIT_GATE_RE.match(body)
+        and _CREDIT_PHRASE_RE.search(body)
+        and _AMT_5_RE.search(body)
+    )
+
+
+# ─────── batched fetch ───────
+# BODYSTRUCTURE tells us where the text/plain part lives and how it is
+# transfer‑encoded; section 1 is fetched speculatively alongside it
+# because that is where UPI mails keep it (the text/plain half of a
+# multipart/alternative, or the whole body of a single‑part mail); the
+# parts after it – HTML alternative, attachments – stay on the server.
+# When part 1 is itself multipart (mixed → alternative) the guess misses:
+# section 1 then carries the HTML too, and _plain_bodies fetches the
+# nested text/plain part in a second round trip.
+# There is no subject‑only pre‑fetch: the amount, the debit wording and
+# the reference all live in the body, so it would add a round trip per
+# poll without ruling out a single mail.
+_FETCH_ITEMS = "(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT)] BODY.PEEK[1])"
+_ATOM_RE     = re.compile(rb'[^\s()"{\[\]]+(?:\[[^\]]*\](?:<\d+>)?)?')  # incl. BODY[HEADER.FIELDS (…)]
+_BODY_KEY_RE = re.compile(rb"BODY\[([^\]]*)\](?:<\d+>)?$")
+
+def _parse_list(buf: bytes, i: int) -> tuple[list, int]:
+    """
+    Parses the parenthesised IMAP list opening at buf[i] → (items, end).
+    Atoms, quoted strings and literals become bytes, NIL becomes None.
+    """
+    out: list = []
+    i += 1
+    while i < len(buf):
+        c = buf[i]
+        if c == 0x20:                                   # SP
+            i += 1
+        elif c == 0x29:                                 # )
+            return out, i + 1
+        elif c == 0x28:                                 # (
+            item, i = _parse_list(buf, i)
+            out.append(item)
+        elif c == 0x22:                                 # "quoted"
+            chunk, i = bytearray(), i + 1
+            while buf[i] != 0x22:
+                i += buf[i] == 0x5C                     # backslash escape
+                chunk.append(buf[i])
+                i += 1
+            out.append(bytes(chunk))
+            i += 1
+        elif c == 0x7B:                                 # {size}\r\n literal
+            j     = buf.index(b"}", i)
+            start = j + 3
+            end   = start + int(buf[i + 1:j])
+            out.append(buf[start:end])
+            i = end
+        else:
+            m = _ATOM_RE.match(buf, i)
+            if not m:
+                raise imaplib.IMAP4.error(f"unparsable FETCH response at {buf[i:i + 20]!r}")
+            out.append(None if m.group() == b"NIL" else m.group())
+            i = m.end()
+    raise imaplib.IMAP4.error("truncated FETCH response")
 
-    wanted_phrase = (
-        "successfully credited" in body_lc
-        or "has been credited" in body_lc
-        or "credited to your account" in body_lc
+def _fetch_batch(mail: imaplib.IMAP4_SSL, uids: list[bytes], items: str = _FETCH_ITEMS) -> dict[bytes, dict]:
+    """
+    One UID FETCH for the whole batch → {uid: {item: value}}, with
+    BODY[sec] items keyed by sec alone (b"1", b"HEADER.FIELDS …").
+    imaplib splits the reply at every literal; it is stitched back into
+    wire format first so BODYSTRUCTURE and bodies parse alike.
+    """
+    _, data = mail.uid("FETCH", b",".join(uids), items)
+    buf = b"".join(
+        item[0] + b"\r\n" + item[1] if isinstance(item, tuple) else item + b"\r\n"
+        for item in data or () if item is not None
     )
-    return wanted_phrase and bool(_AMT_5_RE.search(body_lc))
+    out: dict[bytes, dict] = {}
+    i = 0
+    while (i := buf.find(b"(", i)) != -1:
+        fields, i = _parse_list(buf, i)
+        msg = {}
+        for key, value in zip(fields[::2], fields[1::2]):
+            m = _BODY_KEY_RE.match(key or b"")
+            msg[m.group(1) if m else key.upper()] = value
+        uid = msg.pop(b"UID", None)
+        if uid is not None:                             # unsolicited FLAGS updates carry none
+            out[uid] = msg
+    return out
+
 
+# ─────── text/plain lookup + decoding ───────
+# Everything is decoded straight from the fetched bytes – no
+# email.message.Message is ever built.
+_SUBJECT_RE = re.compile(rb"^Subject:[ \t]*(.*(?:\r?\n[ \t].*)*)", re.M | re.I)
 
-# ─────── poll inbox ───────
-def poll_email() -> Optional[str]:
+def _subject(header: bytes) -> str:
+    m = _SUBJECT_RE.search(header)
+    if not m:
+        return ""
+    raw = re.sub(rb"\r?\n[ \t]", b" ", m.group(1)).strip().decode("utf-8", "replace")
+    if "=?" not in raw:                       # no RFC 2047 encoded‑words
+        return raw
+    # the policy parser records bad charsets as defects instead of raising
+    return str(email.policy.default.header_factory("Subject", raw))
+
+def _find_plain(bs: list | None, prefix: bytes = b"") -> tuple[bytes, bytes] | None:
     """
-    Returns new txn‑id (str) or None.
+    Depth‑first walk of a BODYSTRUCTURE → (section, transfer‑encoding)
+    of the first text/plain part. A single‑part mail is section 1.
     """
-    with imap_lock:
+    if not bs:
+        return None
+    if isinstance(bs[0], list):               # multipart: (part)(part)… subtype ext…
+        for n, child in enumerate(bs, 1):
+            if not isinstance(child, list):
+                break
+            hit = _find_plain(child, prefix + b"%d." % n)
+            if hit:
+                return hit
+        return None
+    if len(bs) > 5 and (bs[0] or b"").lower() == b"text" and (bs[1] or b"").lower() == b"plain":
+        return prefix.rstrip(b".") or b"1", (bs[5] or b"7bit").lower()
+    return None
+
+def _decode_body(body: bytes, cte: bytes) -> bytes:
+    if cte == b"quoted-printable":
+        return quopri.decodestring(body)
+    if cte == b"base64":
         try:
-            with _imap_login() as mail:
-                mail.select("inbox")
-                _, data = mail.search(None, "(UNSEEN)")
-                for uid in (data[0] or b"").split()[-30:][::-1]:
-                    if uid in seen_uids:
-                        continue
-
-                    _, msg_data = mail.fetch(uid, "(RFC822)")
-                    msg   = email.message_from_bytes(msg_data[0][1])
-
-                    # plain‑text part
-                    body = ""
-                    for part in msg.walk():
-                        if part.get_content_type() == "text/plain":
-                            body = (part.get_payload(decode=True) or b"").decode(
-                                errors="ignore"
-                            )
-                            break
-
-                    body_lc = body.lower()
-
-                    # ---------- filters ----------
-                    if not _looks_like_credit(body_lc):
-                        log("skip – not a ₹5 credit")
-                        continue
-
-                    txn_id = _extract_txn_id(body)
-                    if txn_id in seen_txn_ids:
-                        log("skip – already logged")
-                        continue
-
-                    # ---------- success ----------
-                    seen_uids.add(uid)
-                    mail.store(uid, "+FLAGS", "\\Seen")  # mark read
-                    log(f"UID {uid.decode()} → {txn_id}")
-                    return txn_id
+            return binascii.a2b_base64(body)
+        except binascii.Error:
+            return b""
+    return body
+
+def _top_header(parts: dict) -> bytes:
+    return next((v for k, v in parts.items() if k.startswith(b"HEADER")), b"") or b""
+
+def _plain_bodies(mail: imaplib.IMAP4_SSL, fetched: dict[bytes, dict]) -> dict[bytes, bytes]:
+    """
+    Transfer‑decoded text/plain body per UID, as bytes. Parts outside
+    the speculative section 1 (e.g. 1.1 of a nested alternative) cost
+    one extra UID FETCH per distinct section, not one per mail.
+    """
+    plain = {uid: _find_plain(parts.get(b"BODYSTRUCTURE")) for uid, parts in fetched.items()}
+
+    missing: dict[bytes, list[bytes]] = {}
+    for uid, hit in plain.items():
+        if hit and hit[0] not in fetched[uid]:
+            missing.setdefault(hit[0], []).append(uid)
+    for sec, group in missing.items():
+        for uid, got in _fetch_batch(mail, group, f"(UID BODY.PEEK[{sec.decode()}])").items():
+            if uid in fetched:
+                fetched[uid].update(got)
+
+    return {
+        uid: _decode_body(fetched[uid].get(hit[0]) or b"", hit[1]) if hit else b""
+        for uid, hit in plain.items()
+    }
+
+# ─────── UID window ───────
+def _load_uid_window():
+    try:
+        with open(CFG.state_path) as f:
+            state = json.load(f)
+        uid_window.update(
+            uidvalidity = int(state["uidvalidity"]),
+            last_uid    = int(state["last_uid"]),
+            unconfirmed = [int(u) for u in state.get("unconfirmed", ())],
+        )
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log(f"Ignoring unreadable {CFG.state_path}: {e}", "WARN")
+
+def _save_uid_window():
+    tmp = f"{CFG.state_path}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(uid_window, f)
+        os.replace(tmp, CFG.state_path)  # atomic – a crash never leaves half a file
+    except OSError as e:
+        log(f"Could not persist UID window: {e}", "WARN")
 
+def _check_uidvalidity(mail: imaplib.IMAP4_SSL):
+    """
+    UIDs only compare within one UIDVALIDITY – start over if it changed
+    or no state file was found, but look back no further than the newest
+    _SCAN_BATCH matches (the old per‑poll view): the whole history of
+    unread "credited" mail would otherwise be replayed, kept from a
+    second publish by nothing but the Sheets bootstrap.
+    """
+    _, data = mail.response("UIDVALIDITY")
+    validity = int(data[0]) if data and data[0] else 0
+    if validity == uid_window["uidvalidity"]:
+        return
+    if uid_window["uidvalidity"]:
+        log(f"UIDVALIDITY changed {uid_window['uidvalidity']} → {validity} – rescanning inbox", "WARN")
+    uid_window.update(uidvalidity=validity, last_uid=0, unconfirmed=[])
+    matches = sorted(_search_unseen(mail), key=int)
+    if len(matches) > _SCAN_BATCH:
+        uid_window["last_uid"] = int(matches[-_SCAN_BATCH - 1])
+        log(f"No UID window – skipping {len(matches) - _SCAN_BATCH} older unread matches", "WARN")
+    _save_uid_window()
+
+
+# ─────── server‑side search ───────
+def _search_unseen(mail: imaplib.IMAP4_SSL) -> list[bytes]:
+    """
+    UIDs of unread credit mail above uid_window["last_uid"]. "credited"
+    is required server‑side – in Gmail's own search index with
+    GMAIL_RAW_QUERY (X‑GM‑RAW), as a plain IMAP BODY criterion without –
+    so a poll with no hits ends after one round trip. Exclusions and
+    the ₹5 amount are left to _looks_like_credit, which sees only the
+    text/plain part: a mail the server never returns could not be
+    rescued client‑side.
+    """
+    last = uid_window["last_uid"]
+    since = f"{last + 1}:*"
+    if not CFG.gmail_raw_query:
+        _, data = mail.uid("SEARCH", None, "UID", since, "UNSEEN", "BODY", "credited")
+    else:
+        mail.literal = CFG.gmail_raw_query.encode()   # may hold non‑ASCII – send as a literal
+        _, data = mail.uid("SEARCH", "CHARSET", "UTF-8", "UID", since, "X-GM-RAW")
+    # "n:*" always includes the highest UID, even when that is below n
+    return [u for u in (data[0] or b"").split() if int(u) > last]
+
+
+# ─────── poll inbox ───────
+_SCAN_BATCH = 30  # mails per FETCH; a bigger backlog takes several passes
+
+def _still_unseen(mail: imaplib.IMAP4_SSL, uids: list[int]) -> list[bytes]:
+    """
+    The unconfirmed UIDs that are still in the inbox and unread.
+    """
+    if not uids:
+        return []
+    _, data = mail.uid("SEARCH", None, "UID", ",".join(map(str, uids)), "UNSEEN")
+    return (data[0] or b"").split()
+
+def _scan(mail: imaplib.IMAP4_SSL, retry: bool = False) -> tuple[list[str], bool]:
+    """
+    One search → fetch → store pass over the oldest _SCAN_BATCH matches
+    (plus, with retry, the unconfirmed ones) → (txn‑ids, more waiting).
+    The UID window only advances once the whole pass went through, so a
+    dropped connection never loses mail. A mail whose duplicate check
+    couldn't be confirmed is parked in uid_window["unconfirmed"] instead
+    of holding the window back.
+    """
+    matches = sorted(_search_unseen(mail), key=int)
+    uids    = matches[:_SCAN_BATCH]
+    retried = _still_unseen(mail, uid_window["unconfirmed"]) if retry else []
+    if not uids and not retried:
+        if retry and uid_window["unconfirmed"]:          # read or deleted meanwhile
+            uid_window["unconfirmed"] = []
+            _save_uid_window()
+        return [], False
+
+    found: list[str]         = []
+    credited: list[bytes]    = []
+    unconfirmed: list[bytes] = []
+    fetched = _fetch_batch(mail, retried + uids)
+    for uid, body in _plain_bodies(mail, fetched).items():
+        # ---------- filters ----------
+        if not _looks_like_credit(body):
+            log(f"skip – not a ₹5 credit: {_subject(_top_header(fetched[uid]))!r}")
+            continue
+
+        txn_id = _extract_txn_id(body, uid)
+        try:
+            duplicate = txn_id in found or txn_id in seen_txn_ids
         except Exception as e:
-            log(f"Gmail Error: {e}", "ERROR")
+            log(f"UID {uid.decode()} → {txn_id}: duplicate check failed ({e}) – retrying shortly", "ERROR")
+            unconfirmed.append(uid)
+            continue
+        if duplicate:
+            log("skip – already logged")
+            continue
 
-    return None
+        # ---------- success ----------
+        credited.append(uid)
+        found.append(txn_id)
+        log(f"UID {uid.decode()} → {txn_id}")
+
+    # one bulk STORE instead of one per UID
+    if credited:
+        mail.uid("STORE", b",".join(credited), "+FLAGS", "\\Seen")  # mark read
+    # retry replaces the old list – whatever was confirmed is dropped from it
+    pending = set() if retry else set(uid_window["unconfirmed"])
+    pending = sorted(pending | {int(u) for u in unconfirmed})
+    last    = max([int(u) for u in uids], default=uid_window["last_uid"])
+    if last > uid_window["last_uid"] or pending != uid_window["unconfirmed"]:
+        uid_window.update(last_uid=max(last, uid_window["last_uid"]), unconfirmed=pending)
+        _save_uid_window()
+    return found, len(matches) > len(uids)
+
+def poll_email() -> list[str]:
+    """
+    Returns new txn‑ids (possibly empty), oldest first. A backlog
+    bigger than one batch is drained right away, batch after batch.
+    """
+    found: list[str] = []
+    with imap_lock:
+        for attempt in (1, 2):
+            try:
+                retry = True                    # unconfirmed mails once per poll
+                while True:
+                    txn_ids, more = _scan(_imap_conn(), retry)
+                    found += txn_ids
+                    retry = False
+                    if not more:
+                        return found
+            except imaplib.IMAP4.abort as e:
+                # socket died under us – reconnect and rescan right away,
+                # otherwise the waiting mail sits until the next EXISTS
+                log(f"Gmail connection lost: {e}", "WARN")
+                _imap_drop()
+            except Exception as e:
+                log(f"Gmail Error: {e}", "ERROR")
+                _imap_drop()
+                break
+    return found
+
+
+# ─────── wait for new mail ───────
+def wait_for_mail() -> bool:
+    """
+    IDLEs on the shared connection until Gmail pushes new mail (True)
+    or IDLE_RENEW_SECONDS pass (False) – the caller just re‑IDLEs.
+    Mails left unconfirmed cut the wait to UNCONFIRMED_RETRY_SECONDS.
+    """
+    timeout = CFG.unconfirmed_retry_seconds if uid_window["unconfirmed"] else CFG.idle_renew_seconds
+    with imap_lock:
+        return _idle(_imap_conn(), timeout)
 #╰────────────────────────────────────────────────────────────────╯
 
 # ╭─ PROCESSOR ───────────────────────────────────────────────────╮
+def _next_batch() -> list[str]:
+    """
+    Blocks for the next txn; with COALESCE_PAYMENTS also drains
+    everything else that queued up during the cooldown.
+    """
+    batch = [txn_queue.get()]
+    wait_time = CFG.cooldown_seconds - (time.time() - last_processed)
+    if wait_time > 0:
+        log(f"Cooldown: {int(wait_time)}s")
+        time.sleep(wait_time)
+    while CFG.coalesce_payments:
+        try:
+            batch.append(txn_queue.get_nowait())
+        except Empty:
+            break
+    return batch
+
 def processor():
+    """
+    Blocks on txn_queue.get() – no wakeups while idle – then sleeps out
+    whatever is left of the cooldown before publishing.
+    """
     global last_processed
     while True:
-        if queue:
-            now = time.time()
-            if now - last_processed >= COOLDOWN_SECONDS:
-                txn_id = queue.popleft()
-                status[txn_id] = "Processing"
-                log(f"⚙ Processing {txn_id}")
-                ok = send_mqtt()
-                status[txn_id] = "Completed" if ok else "Failed"
-                log(("✔" if ok else "❌") + f" Completed {txn_id}")
-                last_processed = time.time()
-            else:
-                remain = int(COOLDOWN_SECONDS - (time.time() - last_processed))
-                log(f"Cooldown: {remain}s")
-        time.sleep(1)
+        batch   = _next_batch()
+        label   = ", ".join(batch)
+        payload = json.dumps({"count": len(batch), "ids": batch}) if CFG.coalesce_payments else "paid"
+
+        for txn_id in batch:
+            status[txn_id] = "Processing"
+        log(f"⚙ Processing {label}")
+        ok = send_mqtt(payload)
+        for txn_id in batch:
+            status[txn_id] = "Completed" if ok else "Failed"
+            txn_queue.task_done()
+        log(("✔" if ok else "❌") + f" Completed {label}")
+        last_processed = time.time()
 # ╰────────────────────────────────────────────────────────────────╯
 
 # ╭─ FLASK ───────────────────────────────────────────────────────╮
 app = Flask(__name__)
 
+# constant markup, only the counter is interpolated per hit
+_ROOT_TMPL   = b"<h3>Zenorc Payment Processor</h3><p>Status: running</p><p>Queue length: %d</p>"
+_HEALTH_BODY = b'{"ok":true}'
+# lets uptime pingers / proxies reuse a response for a few seconds –
+# short enough that a dead worker still shows up almost at once
+_CACHE_HDRS  = {"Cache-Control": "max-age=5"}
+
 @app.route("/")
 def root():
-    return (
-        "<h3>Zenorc Payment Processor</h3>"
-        f"<p>Status: running</p><p>Queue length: {len(queue)}</p>"
-    )
+    return Response(_ROOT_TMPL % txn_queue.qsize(), mimetype="text/html", headers=_CACHE_HDRS)
 
 @app.route("/health")
 def health():
-    return jsonify(ok=True)
+    return Response(_HEALTH_BODY, mimetype="application/json", headers=_CACHE_HDRS)
 # ╰────────────────────────────────────────────────────────────────╯
 
 # ╭─ MAIN LOOP ───────────────────────────────────────────────────╮
 def main_loop():
     log("Scanning inbox for payments…")
+    failures = 0
     while True:
-        txn_id = poll_email()
-        if txn_id and txn_id not in status and txn_id not in seen_txn_ids:
+        txn_ids = [t for t in poll_email() if t not in status]  # _scan already checked seen_txn_ids
+        for txn_id in txn_ids:
             status[txn_id] = "Queued"
             log_payment(txn_id)
-            queue.append(txn_id)
+            txn_queue.put(txn_id)  # blocks when full – backpressure, not OOM
             log(f"Queued {txn_id}")
+        if txn_ids:
             log("Scanning inbox for payments…")
-        time.sleep(3)
+
+        # block until Gmail pushes new mail instead of polling
+        try:
+            wait_for_mail()
+            failures = 0
+        except Exception as e:
+            failures += 1
+            delay = backoff(failures)
+            log(f"IMAP IDLE Error: {e} – retrying in {delay:.0f}s", "ERROR")
+            with imap_lock:
+                _imap_drop()
+            time.sleep(delay)
+# ╰────────────────────────────────────────────────────────────────╯
+
+# ╭─ STARTUP ─────────────────────────────────────────────────────╮
+_started    = threading.Event()
+_start_lock = threading.Lock()
+
+def start():
+    """
+    Connects and starts the background workers exactly once, whichever
+    entry point (this file, zen.py, a WSGI server) calls it first –
+    importing the module itself opens no connections.
+    """
+    global _MQTT_CLIENT
+    with _start_lock:
+        if _started.is_set():
+            return
+        if os.getenv("SEARCH_STRINGS"):     # removed setting – don't drop it silently
+            log("SEARCH_STRINGS is no longer read – put search terms into GMAIL_RAW_QUERY", "WARN")
+        _load_uid_window()
+        _bootstrap_txns()
+        _MQTT_CLIENT = _mqtt_client()
+        for target in (_sheet_worker, processor, main_loop):
+            threading.Thread(target=target, daemon=True).start()
+        _started.set()
 # ╰────────────────────────────────────────────────────────────────╯
 
 if __name__ == "__main__":
-    threading.Thread(target=processor, daemon=True).start()
-    threading.Thread(target=main_loop, daemon=True).start()
+    from waitress import serve
 
+    start()
     port = int(os.getenv("PORT", "5000"))
-    app.run(host="0.0.0.0", port=port, debug=False)
+    serve(app, host="0.0.0.0", port=port, threads=8)